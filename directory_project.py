@@ -12,6 +12,23 @@ import kate
 import kate.gui
 from ConfigParser import ConfigParser
 from time import time
+import os
+import re
+import fnmatch
+import threading
+import socket
+import errno
+import json
+import stat
+import fcntl
+import subprocess
+import math
+import sys
+
+# the index daemon sits next to us and is plain python, so share its helpers rather than keep copies
+PLUGIN_DIR = os.path.dirname(os.path.abspath(__file__))
+if PLUGIN_DIR not in sys.path: sys.path.append(PLUGIN_DIR)
+from directory_project_daemon import socketPath, toStr, isStale, Sweeper
 
 dProject = None
 
@@ -34,20 +51,474 @@ class PixmapSetter:
     lvi.setPixmap(0, pixmap)
 
 
+# QDir.setNameFilter() semantics (wildcards separated by spaces or semicolons) without going through
+# QDir.match() for every single file name, which recompiles the patterns every time.
+class NameFilter:
+
+  def __init__(self, name_filter):
+    patterns = [x for x in re.split('[ ;]+', str(name_filter).strip()) if x]
+    self.regex = re.compile('|'.join([fnmatch.translate(x) for x in patterns or ['*']]))
+
+  def match(self, file_name):
+    return self.regex.match(file_name) is not None
+
+
+# Reads the start of files we think are about to be opened on a background thread so they're already
+# in the page cache (which matters a lot on NFS) by the time kate gets around to opening them.
+# Python 2 has no posix_fadvise(), so a plain bounded read-ahead it is.  There's one worker thread and it
+# only ever picks up the latest request, so a read stuck on a slow mount can't pile up more behind it.
+class Prefetcher:
+
+  CHUNK_SIZE = 64 * 1024
+
+  def __init__(self, max_files, max_bytes):
+    self.max_files = max_files # how many files a single prefetch() will read (and how many we remember)
+    self.max_bytes = max_bytes # how many bytes a single prefetch() will read, across all its files
+    self.cond = threading.Condition()
+    self.pending = None # the paths the worker should read next, only the latest request is kept
+    self.generation = 0 # bumped by every prefetch() and cancel(), the worker gives up on older ones
+    self.worker = None
+    self.warm = [] # most recently prefetched paths, newest last
+    self.hits = 0
+    self.misses = 0
+
+  # cancels whatever is in flight and has the worker read paths instead
+  def prefetch(self, paths):
+    if not self.max_files or not self.max_bytes: return
+    self.cond.acquire()
+    try:
+      self.generation += 1
+      self.pending = [p for p in paths[:self.max_files] if p not in self.warm] or None
+      if not self.pending: return
+      if not self.worker:
+        self.worker = threading.Thread(target = self.run)
+        self.worker.setDaemon(True)
+        self.worker.start()
+      self.cond.notify()
+    finally:
+      self.cond.release()
+
+  def cancel(self):
+    self.cond.acquire()
+    self.generation += 1
+    self.pending = None
+    self.cond.release()
+
+  def current(self, generation):
+    return generation == self.generation
+
+  # the worker thread, so no touching qt or kate in here
+  def run(self):
+    while True:
+      self.cond.acquire()
+      while not self.pending:
+        self.cond.wait()
+      paths, generation, self.pending = self.pending, self.generation, None
+      self.cond.release()
+      self.read(paths, generation)
+
+  def read(self, paths, generation):
+    budget = self.max_bytes
+    for path in paths:
+      try:
+        f = open(path, 'rb')
+        try:
+          while budget > 0 and self.current(generation):
+            chunk = f.read(min(Prefetcher.CHUNK_SIZE, budget))
+            if not chunk: break
+            budget -= len(chunk)
+        finally:
+          f.close()
+      except (IOError, OSError):
+        continue
+      if not self.current(generation): return
+
+      self.cond.acquire()
+      if path in self.warm: self.warm.remove(path)
+      self.warm.append(path)
+      del self.warm[:-self.max_files]
+      self.cond.release()
+
+      if budget <= 0: return
+
+  # call this when a file actually gets opened so we know whether any of this is worth it
+  def opened(self, path):
+    self.cond.acquire()
+    if path in self.warm:
+      self.hits += 1
+      self.warm.remove(path)
+    else:
+      self.misses += 1
+    self.cond.release()
+    kate.debug("prefetch hit rate: %d/%d (%.0f%%)" % \
+      (self.hits, self.hits + self.misses, 100.0 * self.hits / (self.hits + self.misses)))
+
+
+# Talks to directory_project_daemon.py, which owns the scan and the watches for a project so that several
+# kate windows on the same checkout share them.  Messages are read off the socket from the qt event loop
+# and handed to DirectoryProject.daemonMessage().
+class IndexClient:
+
+  DAEMON_PATH = os.path.join(PLUGIN_DIR, 'directory_project_daemon.py')
+
+  CONNECT_ATTEMPTS = 20 # while the daemon we just started comes up
+  CONNECT_RETRY = 100   # ms between attempts
+
+  def __init__(self, dp):
+    self.dp = dp
+    self.sock = None
+    self.notifier = None
+    self.buffer = ''
+    self.subscription = None
+    self.attempts = 0
+    self.timer = QTimer()
+    QObject.connect(self.timer, SIGNAL("timeout()"), self.tryConnect)
+
+  def socketPath(self):
+    return socketPath(os.path.dirname(self.dp.config_path))
+
+  # only talk to a socket that's ours, in a dir nobody else can get into.  anything else and we'd be
+  # trusting an index from whoever got there first.
+  def socketIsOurs(self):
+    try:
+      dir_st = os.lstat(os.path.dirname(self.socketPath()))
+      sock_st = os.lstat(self.socketPath())
+    except OSError:
+      return False
+    if not stat.S_ISDIR(dir_st.st_mode) or dir_st.st_uid != os.getuid() or dir_st.st_mode & 0o77:
+      kate.debug("index daemon dir is not private, not using it: " + os.path.dirname(self.socketPath()))
+      return False
+    if not stat.S_ISSOCK(sock_st.st_mode) or sock_st.st_uid != os.getuid():
+      kate.debug("index daemon socket is not ours, not using it: " + self.socketPath())
+      return False
+    return True
+
+  # connects to the daemon, starting it first if nobody is listening.  retries happen off a timer so the
+  # gui never waits on the daemon starting up; if it never does, we fall back through daemonLost().
+  def connect(self):
+    self.attempts = 0
+    self.tryConnect()
+
+  def tryConnect(self):
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+      if not self.socketIsOurs(): raise socket.error(errno.ENOENT, "no usable socket")
+      sock.connect(self.socketPath())
+    except socket.error:
+      sock.close()
+      if self.attempts == 0: self.spawn()
+      self.attempts += 1
+      if self.attempts < IndexClient.CONNECT_ATTEMPTS:
+        self.timer.start(IndexClient.CONNECT_RETRY, True)
+      else:
+        kate.debug("could not connect to the index daemon")
+        self.dp.daemonLost()
+      return
+
+    sock.setblocking(0)
+    self.sock = sock
+    self.notifier = QSocketNotifier(sock.fileno(), QSocketNotifier.Read)
+    QObject.connect(self.notifier, SIGNAL("activated ( int )"), self.read)
+
+    # whatever got asked for while we were still connecting
+    if self.subscription:
+      root, ignore = self.subscription
+      self.send({'cmd': 'subscribe', 'root': root, 'ignore': ignore})
+
+  # the shell backgrounds the daemon and exits right away, so it gets reparented instead of left as our zombie
+  def spawn(self):
+    kate.debug("starting index daemon: " + IndexClient.DAEMON_PATH)
+    cache_dir = os.path.dirname(self.dp.config_path)
+    watch_budget = self.dp.config.get('general', 'watch_budget')
+    subprocess.Popen(['sh', '-c', 'python "$0" "$1" "$2" </dev/null &', IndexClient.DAEMON_PATH, cache_dir, watch_budget], close_fds = True).wait()
+
+  def disconnect(self):
+    if self.notifier:
+      self.notifier.setEnabled(False)
+      self.notifier = None
+    if self.sock:
+      self.sock.close()
+      self.sock = None
+
+  def send(self, message):
+    try:
+      self.sock.sendall(json.dumps(message) + '\n')
+    except socket.error as e:
+      kate.debug("lost the index daemon: %s" % e)
+      self.disconnect()
+      self.dp.daemonLost()
+
+  def subscribe(self, root, ignore):
+    if self.subscription and self.subscription != (root, ignore):
+      self.unsubscribe()
+    self.subscription = (root, ignore)
+    if self.sock:
+      self.send({'cmd': 'subscribe', 'root': root, 'ignore': ignore})
+
+  def unsubscribe(self):
+    if self.subscription:
+      root, ignore = self.subscription
+      self.subscription = None
+      if self.sock:
+        self.send({'cmd': 'unsubscribe', 'root': root, 'ignore': ignore})
+
+  def read(self, fd):
+    while self.sock:
+      try:
+        data = self.sock.recv(1 << 20)
+      except socket.error as e:
+        if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK): return
+        data = ''
+      if not data:
+        kate.debug("lost the index daemon")
+        self.disconnect()
+        self.dp.daemonLost()
+        return
+
+      self.buffer += data
+      lines = self.buffer.split('\n')
+      self.buffer = lines.pop()
+      for line in lines:
+        self.dp.daemonMessage(toStr(json.loads(line)))
+
+
+# Keeps the number of live KDirWatch watches bounded on huge trees.  The project root, every expanded dir in
+# the browser and the dirs that changed most recently are watched, up to the budget.  Everything else is
+# cold and gets checked by an mtime sweep instead, a slice at a time, backing off while nothing changes.
+class WatchBudget:
+
+  POLL_MIN = 2000    # ms between sweeps while things are changing
+  POLL_MAX = 60000   # ms between sweeps once they've been quiet for a while
+  SWEEP_TICK = 50    # ms between slices of a single sweep
+  SWEEP_SLICE = 0.01 # seconds of stat()ing cold dirs per slice, this is the gui thread
+
+  def __init__(self, dp, budget):
+    self.dp = dp
+    self.budget = max(1, budget) # the root always gets one
+    self.sweeper = Sweeper(WatchBudget.POLL_MIN, WatchBudget.POLL_MAX, WatchBudget.SWEEP_SLICE)
+    self.timer = QTimer()
+    QObject.connect(self.timer, SIGNAL("timeout()"), self.poll)
+    self.reset()
+
+  def reset(self):
+    self.timer.stop()
+    self.root = None # always watched, whatever happens to the others
+    self.pinned = [] # expanded dirs, in the order they were pinned
+    self.recent = [] # recently changed dirs, most recent last
+    self.watched = set()
+    self.sweeper.reset()
+
+  # only needed when we do our own watching, the index daemon takes care of itself
+  def start(self):
+    if self.dp.dir_watcher:
+      self.timer.start(self.sweeper.interval, True)
+
+  def pinRoot(self, path):
+    self.root = path
+    self.refresh(path)
+    self.rebalance()
+
+  def pin(self, path):
+    if path == self.root or path in self.pinned: return
+    self.pinned.append(path)
+    self.refresh(path)
+    self.rebalance()
+
+  def unpin(self, path):
+    if path in self.pinned:
+      self.pinned.remove(path)
+      self.rebalance()
+
+  def touch(self, path):
+    if path in self.recent: self.recent.remove(path)
+    self.recent.append(path)
+    del self.recent[:-self.budget]
+    self.rebalance()
+
+  # the dir is gone (or moved), stop watching it
+  def remove(self, path):
+    if path in self.pinned: self.pinned.remove(path)
+    if path in self.recent: self.recent.remove(path)
+    if path in self.watched:
+      self.watched.discard(path)
+      self.dp.unwatchDir(path)
+
+  def moved(self, old_path, new_path):
+    was_pinned = old_path in self.pinned
+    self.remove(old_path)
+    if was_pinned: self.pin(new_path)
+
+  # watches the root and pinned dirs first, then the most recently changed ones, up to the budget
+  def rebalance(self):
+    wanted = set()
+    for path in [self.root] + self.pinned + self.recent[::-1]:
+      if len(wanted) >= self.budget: break
+      if path in self.dp.browser.items: wanted.add(path)
+
+    for path in self.watched.difference(wanted):
+      self.dp.unwatchDir(path)
+    for path in wanted.difference(self.watched):
+      self.dp.watchDir(path)
+    self.watched = wanted
+
+  # it may well have changed while nobody was watching, so don't wait for the sweep to notice
+  def refresh(self, path):
+    if self.dp.dir_watcher and path not in self.watched and self.stale(path):
+      self.dp.dirDirtied(path)
+
+  def stale(self, path):
+    mtime, scanned = self.dp.mtimes.get(path, (None, 0))
+    return isStale(path, mtime, scanned)
+
+  # checks the next slice of cold dirs, see Sweeper
+  def poll(self):
+    interval = self.sweeper.step(self.coldDirs, self.check)
+    if interval is None:
+      self.timer.start(WatchBudget.SWEEP_TICK, True)
+      return
+    kate.debug("watching %d dirs, polling %d cold ones, next sweep in %dms" % \
+      (len(self.watched), len(self.dp.index) - len(self.watched), interval))
+    self.timer.start(interval, True)
+
+  def coldDirs(self):
+    return [p for p in self.dp.index if p not in self.watched and p in self.dp.browser.items]
+
+  def check(self, path):
+    return path in self.dp.index and self.stale(path) and self.dp.dirDirtied(path)
+
+
+# Remembers which files get opened in each project, as a frecency score that halves every HALF_LIFE seconds
+# and gets +1 per open.  Since every score decays at the same rate, rank() turns it into a number that never
+# needs updating: log2(score) + time of last open / HALF_LIFE orders things the same way the decayed scores do.
+# Every kate window shares the file, so each change is made to what's in it right then, with it locked.
+class OpenHistory:
+
+  HALF_LIFE = 7 * 24 * 3600.0 # a week
+  MAX_ENTRIES = 500           # per project, the lowest ranked ones get dropped
+
+  def __init__(self, path):
+    self.path = path
+    self.projects = {} # project path => {file path: [score, time of last open]}
+    try:
+      f = open(path)
+      try:
+        fcntl.flock(f.fileno(), fcntl.LOCK_SH)
+        self.reload(f)
+      finally:
+        f.close()
+    except (IOError, OSError):
+      pass
+
+  # locks the file, picks up what other windows saved, runs change() on that and writes the result back
+  def update(self, change):
+    try:
+      f = open(self.path, 'a+')
+    except (IOError, OSError) as e:
+      kate.debug("could not save open history: %s" % e)
+      change()
+      return
+    try:
+      try:
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        self.reload(f)
+        change()
+        f.seek(0)
+        f.truncate()
+        json.dump(self.projects, f)
+      except (IOError, OSError) as e:
+        kate.debug("could not save open history: %s" % e)
+    finally:
+      f.close()
+
+  # every change gets written straight away, so the file is always at least as new as what we have
+  def reload(self, f):
+    f.seek(0)
+    try:
+      self.projects = toStr(json.load(f))
+    except ValueError:
+      pass # empty (new) or mangled, keep what we have
+
+  # returns None for files that were never opened
+  def rank(self, project, path):
+    return OpenHistory.entryRank(self.projects.get(project, {}).get(path))
+
+  # for callers that already have the project's entries at hand
+  @staticmethod
+  def entryRank(entry):
+    if not entry: return None
+    score, last = entry
+    return math.log(score, 2) + last / OpenHistory.HALF_LIFE
+
+  # returns the paths that had to be forgotten to stay under MAX_ENTRIES
+  def record(self, project, path):
+    dropped = []
+    def change():
+      now = time()
+      entries = self.projects.setdefault(project, {})
+      score, last = entries.get(path, (0.0, now))
+      entries[path] = [score * 2 ** ((last - now) / OpenHistory.HALF_LIFE) + 1, now]
+
+      if len(entries) > OpenHistory.MAX_ENTRIES:
+        ranked = sorted(entries.keys(), key = lambda p: self.rank(project, p))
+        dropped.extend(ranked[:len(entries) - OpenHistory.MAX_ENTRIES])
+        for p in dropped:
+          del entries[p]
+
+    self.update(change)
+    return dropped
+
+  # keeps files' history when they (or a dir above them) get moved.  takes (old path, new path) pairs so a
+  # whole moved tree goes in one write.
+  def move(self, project, moves):
+    def change():
+      entries = self.projects.get(project, {})
+      for old_path, new_path in moves:
+        if old_path in entries:
+          entries[new_path] = entries.pop(old_path)
+    self.update(change)
+
+
+# Turns off sorting and repainting on a list view while lots of items go in, then sorts and repaints
+# once at the end.  Otherwise every single insert pays for it.
+class BulkInsert:
+
+  @staticmethod
+  def begin(list_view):
+    list_view.setUpdatesEnabled(False)
+    list_view.setSorting(-1)
+
+  @staticmethod
+  def end(list_view, column = 0):
+    list_view.setSorting(column)
+    list_view.sort()
+    list_view.setUpdatesEnabled(True)
+    list_view.triggerUpdate()
+
+
 class ListViewItem(KListViewItem):
 
-  def __init__(self, parent, label, path):
-    KListViewItem.__init__(self, parent, label)
+  # with sorting off, items go wherever they're put, so pass after to keep them in order
+  def __init__(self, parent, label, path, after = None):
+    if after:
+      KListViewItem.__init__(self, parent, after, label)
+    else:
+      KListViewItem.__init__(self, parent, label)
     self.path = path
     self.is_dir = False
     
 
 class DirectoryProject():
 
+  # addItems() batches at least this big get sorting and repainting suspended
+  BULK_THRESHOLD = 50
+  # this many items of the first bulk batch go in one at a time instead, as a baseline to compare with
+  INSERT_SAMPLE = 10
+
   def __init__(self, tool_widget):
 
     # we have to init the config first because all the widget __init__ methods below need it too
     self.initConfig()
+    self.history = OpenHistory(kate.pate.pluginDirectories[1] + "/%s/%s.history" % (__name__, __name__))
 
     # all of our "child" widget
     self.browser  = DPBrowser(tool_widget)
@@ -56,9 +527,22 @@ class DirectoryProject():
     
     self.dir_watcher = None
     self.open_project = None
+    self.index = {} # dir path => ([dir names], [file names]), unfiltered
+    self.mtimes = {} # dir path => (its mtime, time it was scanned) as of the last scan
+    self.insert_baseline = None # seconds per item inserting one at a time, see addItems()
+    self.watches = WatchBudget(self, self.config.getint('general', 'watch_budget'))
+    self.ignore_list = []
+
+    # optionally share the scan and the watches with other kate windows through the index daemon
+    self.index_client = None
+    if self.config.get('general', 'index_daemon') == 'yes':
+      self.index_client = IndexClient(self)
+      self.index_client.connect()
 
     QObject.connect(self.browser, SIGNAL("doubleClicked ( QListViewItem *, const QPoint &, int )"), self.openItem)
     QObject.connect(self.finder.list_view, SIGNAL("doubleClicked ( QListViewItem *, const QPoint &, int )"), self.openItem)
+    QObject.connect(self.browser, SIGNAL("expanded ( QListViewItem * )"), self.dirExpanded)
+    QObject.connect(self.browser, SIGNAL("collapsed ( QListViewItem * )"), self.dirCollapsed)
 
     self.initMenu()
 
@@ -121,6 +605,10 @@ class DirectoryProject():
     if not config.has_option('DEFAULT', 'finder_size'): config.set('DEFAULT', 'finder_size', '400x450')
     if not config.has_option('DEFAULT', 'config_size'): config.set('DEFAULT', 'config_size', '300x350')
     if not config.has_option('DEFAULT', 'search_type'): config.set('DEFAULT', 'search_type', 'word')
+    if not config.has_option('DEFAULT', 'prefetch_files'): config.set('DEFAULT', 'prefetch_files', '2')
+    if not config.has_option('DEFAULT', 'prefetch_bytes'): config.set('DEFAULT', 'prefetch_bytes', '1048576')
+    if not config.has_option('DEFAULT', 'index_daemon'): config.set('DEFAULT', 'index_daemon', 'no')
+    if not config.has_option('DEFAULT', 'watch_budget'): config.set('DEFAULT', 'watch_budget', '256')
       
     # create the general section if it doesn't exist
     if not config.has_section('general'): config.add_section('general')
@@ -152,28 +640,312 @@ class DirectoryProject():
     # sanity checks
     if not self.sanityChecks(self.open_project): return
 
+    # parse the ignore list (used further down the call stack)
+    self.loadIgnoreList()
+
+    root_path = self.projectRoot()
+
+    # the index daemon does the scanning for us if we're using it, showIndex() gets called once it answers
+    if self.index_client:
+      self.index_client.subscribe(root_path, self.ignore_list)
+      return
+
+    # rescan the whole project from scratch into the index
+    t1 = time()
+    self.index = {}
+    self.mtimes = {}
+    self.scanDir(root_path)
+    kate.debug("project scan took %f seconds for %d directories" % (time()-t1, len(self.index)))
+
+    self.showIndex(root_path)
+
+  # end def reload()
+
+
+  # puts the index on screen, patching up the tree if it's already showing this project
+  def showIndex(self, root_path):
+    root = self.browser.firstChild()
+    if root and root.path == root_path:
+      self.reconcile(root_path)
+      return
+
     # clear the widgets
     self.browser.clear()
     self.finder.clear()
 
-    # parse the ignore list (used further down the call stack)
+    # init the dir watcher (the index daemon does the watching if we're using it)
+    self.watches.reset()
+    self.dir_watcher = None
+    if not self.index_client:
+      self.dir_watcher = KDirWatch()
+      QObject.connect(self.dir_watcher, SIGNAL("dirty ( const QString & )"), self.dirDirtied)
+      QObject.connect(self.dir_watcher, SIGNAL("deleted ( const QString & )"), self.dirRemoved)
+
+    # time and output the building of the tree
+    t1 = time()
+    entries = []
+    self.indexEntries(root_path, entries)
+    summary = self.addItems(entries)
+    kate.debug("project (re)load took %f seconds (%s)" % (time()-t1, summary))
+
+    # the root is always watched, everything else waits until it's expanded or changes
+    self.watches.pinRoot(root_path)
+    self.watches.start()
+
+
+  def watchDir(self, path):
+    if self.dir_watcher:
+      self.dir_watcher.addDir(path)
+
+
+  def unwatchDir(self, path):
+    if self.dir_watcher:
+      self.dir_watcher.removeDir(path)
+
+
+  # an index or a batch of changed dirs from the index daemon
+  def daemonMessage(self, message):
+    if not self.open_project: return
+    root_path = self.projectRoot()
+    if message.get('root') != root_path: return # left over from the last project
+
+    if message.get('event') == 'index':
+      self.index = dict([(path, tuple(entry)) for path, entry in message['index'].items()])
+      kate.debug("got index from the daemon: %d directories" % len(self.index))
+      self.showIndex(root_path)
+
+    elif message.get('event') == 'changed':
+      changed = message['dirs']
+      for path, entry in changed.items():
+        if entry:
+          self.index[path] = tuple(entry)
+        else:
+          self.index.pop(path, None)
+
+      # all in one go, so a dir that moved from one changed dir to another gets picked up as a move
+      self.reconcileDirs(changed.keys())
+
+
+  # fall back to scanning and watching on our own
+  def daemonLost(self):
+    self.index_client = None
+    self.watches.reset()
+    self.dir_watcher = None
+    self.browser.clear()
+    self.finder.clear()
+    if self.open_project:
+      self.reload()
+
+
+  def loadIgnoreList(self):
     self.ignore_list = self.get_option('ignore')
     if self.ignore_list:
       self.ignore_list = [x.strip() for x in self.ignore_list.split(',')]
     else:
       self.ignore_list = []
 
-    # init the dir watcher
-    self.dir_watcher = KDirWatch()
-    QObject.connect(self.dir_watcher, SIGNAL("dirty ( const QString & )"), self.dirDirtied)
-    QObject.connect(self.dir_watcher, SIGNAL("deleted ( const QString & )"), self.dirRemoved)
-    
-    # time and output the building of the tree
+
+  # called after the filter or ignore settings change.  the new rules are evaluated against the index,
+  # so the only time we hit the disk is for a directory that used to be ignored (and so was never scanned).
+  def applySettings(self):
+    if not self.open_project or not self.browser.firstChild(): return
+    old_ignore_list = self.ignore_list
+    self.loadIgnoreList()
+
+    # the daemon's index depends on the ignore list, so that means subscribing to a different one
+    if self.index_client and old_ignore_list != self.ignore_list:
+      self.reload()
+      return
+
+    # newly ignored dirs won't be watched anymore, so don't trust what we know about them later on
+    for path in self.index.keys():
+      if os.path.basename(path) in self.ignore_list:
+        self.dropDir(path)
+
+    self.reconcile(self.browser.firstChild().path)
+
+
+  # reads a single directory into the index (unfiltered, the filter and ignore list are applied later
+  # by indexEntries()).  subdirs we already know about are left alone, new ones are scanned recursively
+  # unless they're ignored, and ones that disappeared are dropped along with everything under them.
+  def scanDir(self, path):
+    scanned = time()
+    try:
+      self.mtimes[path] = (os.stat(path).st_mtime, scanned)
+    except OSError:
+      self.mtimes[path] = (None, scanned)
+    d = QDir(path)
+    d.setFilter(QDir.Dirs)
+    dirs = [str(name) for name in d.entryList() if str(name) not in ('.', '..')]
+    d.setFilter(QDir.Files)
+    files = [str(name) for name in d.entryList()]
+
+    old = self.index.get(path)
+    self.index[path] = (dirs, files)
+
+    if old:
+      for name in set(old[0]).difference(dirs):
+        self.dropDir(os.path.join(path, name))
+    for name in dirs:
+      sub_path = os.path.join(path, name)
+      if name not in self.ignore_list and sub_path not in self.index:
+        self.scanDir(sub_path)
+
+
+  def dropDir(self, path):
+    self.mtimes.pop(path, None)
+    entry = self.index.pop(path, None)
+    if entry:
+      for name in entry[0]:
+        self.dropDir(os.path.join(path, name))
+
+
+  # walks the index the same way the tree is laid out, collecting (path, is_dir) pairs that pass the
+  # ignore list and name filter.  they come out parents before children, dirs before files.
+  def indexEntries(self, path, entries, file_filter = None):
+    if not self.passIgnore(os.path.basename(path)):
+      return
+    if file_filter is None:
+      file_filter = NameFilter(self.get_option('filter'))
+
+    # an ignored dir never got scanned, so if it's been un-ignored we have to go read it now
+    if path not in self.index:
+      self.scanDir(path)
+
+    entries.append( (path, True) )
+    dirs, files = self.index[path]
+    for name in dirs:
+      self.indexEntries(os.path.join(path, name), entries, file_filter)
+    for name in files:
+      if self.passIgnore(name) and file_filter.match(name):
+        entries.append( (os.path.join(path, name), False) )
+
+
+  # diffs the index against what's in the browser under path and applies only the differences.
+  # since the existing items (and watches) are left alone, expanded and selected state survives.
+  def reconcile(self, path):
     t1 = time()
-    self.addItem(QFileInfo(self.open_project), self.browser)
-    kate.debug("project (re)load took %f seconds" % (time()-t1))
-    
-  # end def reload()
+    entries = []
+    self.indexEntries(path, entries)
+
+    # moves first, that way whatever is left over is a plain add or remove
+    moved = self.findMoves(entries, self.browser.subtree(path))
+    for old_path, new_path in moved:
+      self.moveItem(old_path, new_path)
+
+    added, removed = self.diffTree(entries, self.browser.subtree(path))
+    for p in removed:
+      self.removeItem(p)
+    summary = self.addItems(added)
+
+    kate.debug("reconcile of %s took %f seconds: %d added, %d removed, %d moved%s" % \
+      (path, time()-t1, len(added), len(removed), len(moved), summary and " (%s)" % summary or ""))
+
+  # end def reconcile()
+
+
+  # the cheap reconcile() for dirs whose own listing changed: only their direct children get diffed, and
+  # only dirs that just showed up get walked.  moves between dirs in the same batch are still picked up.
+  def reconcileDirs(self, paths):
+    t1 = time()
+    paths = sorted([p for p in set(paths) if p in self.index and p in self.browser.items])
+    if not paths: return
+
+    file_filter = NameFilter(self.get_option('filter'))
+    entries = []
+    for path in paths:
+      entries.append( (path, True) )
+      dirs, files = self.index[path]
+      for name in dirs:
+        if self.passIgnore(name):
+          entries.append( (os.path.join(path, name), True) )
+      for name in files:
+        if self.passIgnore(name) and file_filter.match(name):
+          entries.append( (os.path.join(path, name), False) )
+
+    moved = self.findMoves(entries, self.browser.childItems(paths))
+    for old_path, new_path in moved:
+      self.moveItem(old_path, new_path)
+
+    added, removed = self.diffTree(entries, self.browser.childItems(paths))
+    for p in removed:
+      self.removeItem(p)
+    new_entries = []
+    for p, is_dir in added:
+      if is_dir:
+        self.indexEntries(p, new_entries, file_filter)
+      else:
+        new_entries.append( (p, is_dir) )
+    summary = self.addItems(new_entries)
+
+    kate.debug("reconcile of %s took %f seconds: %d added, %d removed, %d moved%s" % \
+      (len(paths) == 1 and paths[0] or "%d dirs" % len(paths), time()-t1, len(new_entries), len(removed), len(moved), \
+      summary and " (%s)" % summary or ""))
+
+
+  # returns every (path, is_dir) entry that needs adding (in tree order) and the topmost paths that need
+  # removing to make current match entries.  anything underneath a removed path goes with it in removeItem().
+  def diffTree(self, entries, current):
+    fresh = dict(entries)
+
+    # a path that flipped between file and dir counts as both a remove and an add
+    removed = [p for p, lvi in current.items() if p not in fresh or fresh[p] != lvi.is_dir]
+    removed_set = set(removed)
+    added = [(p, is_dir) for p, is_dir in entries if p not in current or p in removed_set]
+    removed = [p for p in removed if os.path.dirname(p) not in removed_set]
+    return added, removed
+
+
+  # pairs up removed and added paths that have the same name and type, but only when the match is
+  # unambiguous.  those get moved over so their subtrees (and expanded state) don't get rebuilt.
+  def findMoves(self, entries, current):
+    added, removed = self.diffTree(entries, current)
+    added_set = set([p for p, is_dir in added])
+
+    candidates = {}
+    for p in removed:
+      candidates.setdefault( (os.path.basename(p), current[p].is_dir), ([], []) )[0].append(p)
+    for p, is_dir in added:
+      if os.path.dirname(p) in added_set: continue
+      candidates.setdefault( (os.path.basename(p), is_dir), ([], []) )[1].append(p)
+
+    moves = []
+    for old_paths, new_paths in candidates.values():
+      if len(old_paths) != 1 or len(new_paths) != 1:
+        continue
+      old_path, new_path = old_paths[0], new_paths[0]
+      new_parent = current.get(os.path.dirname(new_path))
+      if old_path == new_path or not new_parent or not new_parent.is_dir:
+        continue
+      moves.append( (old_path, new_path) )
+    return moves
+
+
+  def moveItem(self, old_path, new_path):
+    lvi = self.browser.items[old_path]
+    new_parent = self.browser.items[os.path.dirname(new_path)]
+    lvi.parent().takeItem(lvi)
+    new_parent.insertItem(lvi)
+
+    # everything underneath it needs to be re-keyed (and re-watched) under the new path
+    moved_files = []
+    stack = [lvi]
+    while stack:
+      p = stack.pop()
+      path = p.path
+      p.path = new_path + path[len(old_path):]
+      self.browser.items[p.path] = self.browser.items.pop(path)
+      if p.is_dir:
+        self.watches.moved(path, p.path)
+      else:
+        self.finder.moveItem(path, p.path)
+        moved_files.append( (path, p.path) )
+      n = p.firstChild()
+      while n:
+        stack.append(n)
+        n = n.nextSibling()
+    if moved_files:
+      self.history.move(self.projectRoot(), moved_files)
 
   def openProject(self, project_path):
 
@@ -205,8 +977,7 @@ class DirectoryProject():
   # end def openProject()
 
 
-  def passIgnore(self, file_info):
-    file_name = file_info.fileName()
+  def passIgnore(self, file_name):
     if file_name == '.': return False
     if file_name == '..': return False
     if file_name in self.ignore_list: return False
@@ -235,6 +1006,9 @@ class DirectoryProject():
       if not item: continue # what the hell?  something is broken
       if item.is_dir == False:
         kate.debug("file dbl clicked")
+        if self.finder.isVisible():
+          self.finder.prefetcher.opened(item.path)
+        self.recordOpen(item.path)
         kate.documentManager.open(item.path)
         d = kate.documentManager.get(item.path)
         kate.application.activeMainWindow().viewManager().activateView(d.number)
@@ -244,46 +1018,46 @@ class DirectoryProject():
         self.browser.setOpen(item, not self.browser.isOpen(item))
 
 
-  # we only care about files and added dirs here.
+  def recordOpen(self, path):
+    project = self.projectRoot()
+    dropped = self.history.record(project, path)
+    for p in [path] + dropped:
+      self.finder.rerank(p, self.history.rank(project, p))
+
+
+  # the open project as an absolute path with no trailing slash, which is how every item's path starts
+  def projectRoot(self):
+    return str(QFileInfo(self.open_project).absFilePath())
+
+
+  # we only care about files and added dirs here.  returns whether the dir's listing actually changed.
   def dirDirtied(self, path):
     path = str(path)
     kate.debug('dirDirtied: ' + path)
 
-    # find the list view item for the watched directory
-    lvi = self.browser.findItem(path, 1)
-    if not lvi:
+    # make sure it's a directory we actually know about
+    if path not in self.index or path not in self.browser.items:
       kate.debug("cannot find directory: " + path)
-      return
+      return False
 
-    # create a set of all it's children
-    our_set = set()
-    p = lvi.firstChild()
-    while p:
-      our_set.add(str(p.text(1)))
-      p = p.nextSibling()
+    # re-read it into the index and patch up its children in the tree
+    old = self.index[path]
+    self.scanDir(path)
+    if self.index.get(path) == old: return False
+    self.reconcileDirs([path])
 
-    # create a set of all the actual directory's children
-    real_set = set()
-    d = QDir(path)
-    for file_info in d.entryInfoList():
-      if file_info.fileName() == '.':
-        continue
-      if file_info.fileName() == '..':
-        continue
-      real_set.add(str(file_info.absFilePath()))
+    # things that just changed are likely to change again, so keep an eye on it
+    if path in self.browser.items:
+      self.watches.touch(path)
+    return True
 
-    # difference the set and those are our adds
-    set_diff = real_set.difference(our_set)
-    for path in set_diff:
-      file_info = QFileInfo(path)
-      self.addItem(file_info, lvi)
-    kate.debug('added files/dirs: ' + str(set_diff))
 
-    # differece the other way and those are our deletes
-    set_diff = our_set.difference(real_set)
-    kate.debug('removing files/dirs: ' + str(set_diff))
-    for path in set_diff:
-      self.removeItem(path)
+  def dirExpanded(self, item):
+    self.watches.pin(item.path)
+
+
+  def dirCollapsed(self, item):
+    self.watches.unpin(item.path)
 
 
   # we only care about removed dirs here.
@@ -291,45 +1065,71 @@ class DirectoryProject():
     kate.debug('dirRemoved: ' + str(path))
 
 
-  # unlike browser and finder's addItem(), this is recursive
-  def addItem(self, file_info, parent):
+  # entries must be in tree order (parents before children) so every item's parent already exists.
+  # big batches go in with sorting and repainting turned off, each item appended after the last one
+  # under the same parent so they keep the scan's order (dirs first) until the single sort at the end.
+  # returns a summary of how long that took, for the debug log.
+  def addItems(self, entries):
+    if not entries: return None
+    last_child = {} # parent path => last item we put under it
+    opened = self.history.projects.get(self.projectRoot(), {})
 
-    # base case (file)
-    if file_info.isFile():
-      if self.passIgnore(file_info):
-        p = self.browser.addItem(file_info, parent)
-        self.finder.addItem(file_info, p.pixmap(0))
+    if len(entries) < DirectoryProject.BULK_THRESHOLD:
+      t1 = time()
+      self.insertEntries(entries, last_child, opened)
+      return "%d items inserted one at a time in %f seconds" % (len(entries), time()-t1)
 
-    # recursive case (dir)
-    else:
-      d = QDir(file_info.absFilePath())
+    # the first time round, the tail of the batch goes in one at a time after the sort, against the full
+    # list, to get a per-item baseline to hold bulk inserts up against.  just once, it's not cheap.
+    sample = 0
+    if self.insert_baseline is None:
+      sample = min(DirectoryProject.INSERT_SAMPLE, len(entries) // 10)
+    bulk_entries, sample_entries = entries[:len(entries) - sample], entries[len(entries) - sample:]
+
+    t1 = time()
+    BulkInsert.begin(self.browser)
+    BulkInsert.begin(self.finder.list_view)
+    self.insertEntries(bulk_entries, last_child, opened)
+    t2 = time()
+    BulkInsert.end(self.browser)
+    BulkInsert.end(self.finder.list_view, DPFinder.SORT_COLUMN)
+    t3 = time()
+
+    if sample:
+      for entry in sample_entries:
+        self.insertEntries([entry], last_child, opened)
+        # qt only sorts when a list is next looked at (firstChild() or a paint), so make each insert
+        # pay for its sort now, the way it would have with the finder open
+        self.browser.items.get(os.path.dirname(entry[0]), self.browser).firstChild()
+        self.finder.list_view.firstChild()
+      self.insert_baseline = (time()-t3) / sample
+
+    summary = "%d items: %f seconds inserting, %f seconds sorting" % (len(bulk_entries), t2-t1, t3-t2)
+    if self.insert_baseline and t3 > t1:
+      per_item = (t3-t1) / len(bulk_entries)
+      summary += ", %.1fx faster per item than one at a time" % (self.insert_baseline / per_item)
+    return summary
+
+
+  # opened is the project's OpenHistory entries, so the finder doesn't look the project up for every file
+  def insertEntries(self, entries, last_child, opened):
+    last_file = None
+    for path, is_dir in entries:
+      file_info = QFileInfo(path)
+      parent_path = os.path.dirname(path)
+      parent = self.browser.items.get(parent_path, self.browser)
+      p = self.browser.addItem(file_info, parent, last_child.get(parent_path))
+      last_child[parent_path] = p
+      if not is_dir:
+        last_file = self.finder.addItem(file_info, p.pixmap(0), last_file, OpenHistory.entryRank(opened.get(path)))
 
-      if not self.passIgnore(file_info):
-        return
 
-      parent = self.browser.addItem(file_info, parent)
-      
-      # watch this dir for changes
-      self.dir_watcher.addDir(file_info.absFilePath())
-      
-      # do directories first
-      d.setFilter(QDir.Dirs)
-      for file_info in d.entryInfoList():
-        self.addItem(file_info, parent)
-
-      # now do files
-      d.setFilter(QDir.Files)
-      d.setNameFilter(self.config.get(self.open_project, 'filter'))
-      for file_info in d.entryInfoList():
-        self.addItem(file_info, parent)
-      
-    
   # unlike browser and finder's removeItem(), this is recursive
   def removeItem(self, path):
-    p = self.browser.findItem(path, 1)
+    p = self.browser.items[path]
 
     # base case (file)
-    if p.childCount() == 0:
+    if not p.is_dir:
       self.browser.removeItem(path)
       self.finder.removeItem(path)
 
@@ -339,9 +1139,9 @@ class DirectoryProject():
       while n:
         temp = n # the ole linked list gotcha:  if we delete n, then n.nextSibling() will return None
         n = n.nextSibling()
-        self.removeItem(temp.text(1))
+        self.removeItem(temp.path)
       self.browser.removeItem(path)
-      self.dir_watcher.removeDir(path)
+      self.watches.remove(path)
 
 
   def menuOpen(self):
@@ -352,6 +1152,9 @@ class DirectoryProject():
 
   def menuClose(self):
     kate.debug('menuClose()')
+    if self.index_client:
+      self.index_client.unsubscribe()
+    self.watches.reset()
     self.browser.clear()
     self.finder.clear()
     self.open_project = None
@@ -387,20 +1190,60 @@ class DPBrowser(KListView):
     self.header().hide()
     self.addColumn('')
     self.setRootIsDecorated(True)
+    self.items = {} # path => ListViewItem
 
-  def addItem(self, file_info, parent):
-    lvi = ListViewItem(parent, file_info.fileName(), file_info.absFilePath())
+  def addItem(self, file_info, parent, after = None):
+    lvi = ListViewItem(parent, file_info.fileName(), str(file_info.absFilePath()), after)
     lvi.is_dir = file_info.isDir()
     PixmapSetter.set(lvi, file_info.absFilePath(), file_info.isDir())
+    self.items[lvi.path] = lvi
     return lvi
 
   def removeItem(self, path):
-    lvi = self.findItem(path, 1)
-    lvi.parent().takeItem(lvi)
+    lvi = self.items.pop(path)
+    if lvi.parent():
+      lvi.parent().takeItem(lvi)
+    else:
+      self.takeItem(lvi)
+
+  def clear(self):
+    KListView.clear(self)
+    self.items = {}
+
+  # returns path => ListViewItem for path and everything underneath it
+  def subtree(self, path):
+    items = {}
+    stack = [self.items.get(path)]
+    while stack:
+      lvi = stack.pop()
+      if not lvi: continue
+      items[lvi.path] = lvi
+      n = lvi.firstChild()
+      while n:
+        stack.append(n)
+        n = n.nextSibling()
+    return items
+
+  # returns path => ListViewItem for each of paths and their direct children
+  def childItems(self, paths):
+    items = {}
+    for path in paths:
+      lvi = self.items.get(path)
+      if not lvi: continue
+      items[path] = lvi
+      n = lvi.firstChild()
+      while n:
+        items[n.path] = n
+        n = n.nextSibling()
+    return items
     
 
 class DPFinder(KDialog):
-  
+
+  # the list is sorted on a hidden column holding OpenHistory ranks, see sortKey()
+  SORT_COLUMN = 1
+  RECENT_LIMIT = 20 # how many files to show when nothing has been typed in
+
   def __init__(self,parent = None):
     KDialog.__init__(self, kate.mainWidget())
 
@@ -410,6 +1253,9 @@ class DPFinder(KDialog):
 
     self.list_view = KListView(self)
     self.list_view.addColumn(QString.null)
+    self.list_view.addColumn(QString.null, 0)
+    self.list_view.setColumnWidthMode(DPFinder.SORT_COLUMN, QListView.Manual)
+    self.list_view.setSorting(DPFinder.SORT_COLUMN)
     self.list_view.header().hide()
 
     self.lv_search = ListViewSearchLineWidget(self.list_view, self)
@@ -419,37 +1265,110 @@ class DPFinder(KDialog):
 
     self.setSizeGripEnabled(True)
 
+    self.items = {} # path => ListViewItem
+    self.needs_sort = False # rerank() leaves the sorting to the next search
+
+    # warm up whatever is selected (or ranked first) before they hit enter
+    self.prefetcher = Prefetcher(self.dp.config.getint('general', 'prefetch_files'), self.dp.config.getint('general', 'prefetch_bytes'))
+    QObject.connect(self.list_view, SIGNAL("selectionChanged ( QListViewItem * )"), self.selectionChanged)
+
   # end def __init__
 
-  def addItem(self, file_info, pixmap = None):
+  def addItem(self, file_info, pixmap = None, after = None, rank = None):
     project_path = self.dp.open_project
     name = file_info.fileName()
     full_path = file_info.absFilePath()
     dir_path = QString(full_path).remove(name)
-    lvi = ListViewItem(self.list_view, name, full_path)
+    lvi = ListViewItem(self.list_view, name, str(full_path), after)
+    lvi.rank = rank
+    lvi.setText(DPFinder.SORT_COLUMN, DPFinder.sortKey(lvi))
     if pixmap:
       lvi.setPixmap(0, pixmap)
     else:
       PixmapSetter.set(lvi, file_info.absFilePath())
+    self.items[lvi.path] = lvi
+    return lvi
   # end def addItem()
 
   def removeItem(self, path):
-    lvi = self.list_view.findItem(path, 1)
-    self.list_view.takeItem(lvi)
+    lvi = self.items.pop(path, None)
+    if lvi:
+      self.list_view.takeItem(lvi)
+
+  # the file name doesn't change when its directory moves, so only the path needs updating
+  def moveItem(self, old_path, new_path):
+    lvi = self.items.pop(old_path, None)
+    if lvi:
+      lvi.path = new_path
+      self.items[new_path] = lvi
     
   def clear(self):
     self.list_view.clear()
+    self.items = {}
   # end def clear()
 
 
+  # sorting on a plain string column keeps the sort in C++, a python compare() would get called for every
+  # comparison.  files we've opened come first, highest rank first, then everything else by name.
+  @staticmethod
+  def sortKey(lvi):
+    if lvi.rank is None:
+      return '1' + str(lvi.text(0))
+    return '0%016.6f' % (1e9 - lvi.rank)
+
+
+  def rerank(self, path, rank):
+    lvi = self.items.get(path)
+    if lvi:
+      lvi.rank = rank
+      lvi.setText(DPFinder.SORT_COLUMN, DPFinder.sortKey(lvi))
+      self.needs_sort = True
+
+
+  # files get opened far more often than the finder gets searched, so sort then instead
+  def sortIfNeeded(self):
+    if self.needs_sort:
+      self.list_view.sort()
+      self.needs_sort = False
+
+
+  # with nothing typed in, just show the files opened most (and most recently).  they're sorted first, so
+  # this is the first RECENT_LIMIT items.  if nothing has been opened yet, everything stays visible.
+  def showRecent(self):
+    item = self.list_view.firstChild()
+    if not item or item.rank is None: return
+    count = 0
+    while item:
+      visible = item.rank is not None and count < DPFinder.RECENT_LIMIT
+      item.setVisible(visible)
+      if visible: count += 1
+      item = item.nextSibling()
+
+
+  def selectionChanged(self, item):
+    if item:
+      self.prefetcher.prefetch([item.path])
+
+
+  # the first few visible results are the most likely to get opened
+  def prefetchTop(self):
+    paths = []
+    item = self.list_view.firstChild()
+    while item and len(paths) < self.prefetcher.max_files:
+      if item.isVisible():
+        paths.append(item.path)
+      item = item.nextSibling()
+    self.prefetcher.prefetch(paths)
+
+
   # overloaded virtual
   def show(self):
 
     # make sure the search line always has focus
     self.lv_search.searchLine().setFocus()
 
-    # reset the list view
-    self.lv_search.searchLine().resetListView()
+    # reset the list view (which shows recent files if nothing is typed in)
+    self.lv_search.searchLine().updateSearch()
 
     # use the user's preferred size
     x, y = self.dp.config.get('general', 'finder_size').split('x')
@@ -476,6 +1395,9 @@ class DPFinder(KDialog):
       self.dp.config.set('general', 'finder_size', '%dx%d' % (x, y))
       self.dp.saveConfig()
 
+    # nobody is going to open anything now
+    self.prefetcher.cancel()
+
     # default implementation...
     e.accept()
 
@@ -532,6 +1454,9 @@ class ListViewSearchLine(KListViewSearchLine):
 
   def updateSearch(self, s = None):
     t1 = time()
+    if s is None:
+      s = self.text()
+    self.listView().parent().sortIfNeeded()
 
     search_type = self.listView().parent().dp.config.get('general', 'search_type').lower()
     if search_type == 'exact':
@@ -544,10 +1469,15 @@ class ListViewSearchLine(KListViewSearchLine):
       kate.debug("unexpected search type: %s" % search_type)
       return
 
+    if not str(s).strip():
+      self.listView().parent().showRecent()
+
     kate.debug('updateSearch(%s): %f seconds for %d items' % (s, time()-t1, self.listView().childCount()))
     
     self.resetListView()
 
+    self.listView().parent().prefetchTop()
+
   # default KListViewSearchLine search:
   # ment_te =>
   #   docu[ment_te]st
@@ -803,11 +1733,9 @@ class DPSettings(DPSettingsBase):
     # this should close the settings dialog
     QDialog.accept(self)
 
-    # if they changed any settings offer to reload the project
+    # if they changed any settings apply them to what's already loaded, no need for a full reload
     if old_ignore != new_ignore or old_filter != new_filter:
-      result = KMessageBox.questionYesNo(kate.mainWidget(), "Project settings have changed, would you like to reload the project?", "Reload Project?")
-      if result == KMessageBox.Yes:
-        self.dp.reload()
+      self.dp.applySettings()
 
 
 
@@ -0,0 +1,586 @@
+#!/usr/bin/env python
+#
+# Shared project index for the Directory Project kate plugin.
+#
+# Every kate window that opens a project would otherwise scan and watch the whole thing on its own.  Instead,
+# the plugin can connect to this daemon over a per-user unix socket and subscribe to a project root.  The
+# daemon does the scan once, keeps it up to date and pushes changed directories to every subscriber.  Like
+# the plugin's WatchBudget, only the root and the most recently changed dirs get an inotify watch, up to a
+# budget (kernel watches are shared with everything else the user runs); the rest, or everything without
+# inotify, is polled by mtime, backing off while nothing changes.  Indexes are saved to disk when nobody is using them anymore, so the next
+# subscribe only has to stat directories instead of listing them.  The plugin starts the daemon on demand
+# and it exits on its own once idle.
+#
+# Protocol is one JSON object per line in both directions:
+#   plugin => daemon: {"cmd": "subscribe", "root": path, "ignore": [names]}
+#                     {"cmd": "unsubscribe", "root": path, "ignore": [names]}
+#   daemon => plugin: {"event": "index", "root": path, "index": {dir: [[dir names], [file names]]}}
+#                     {"event": "changed", "root": path, "dirs": {dir: [[dir names], [file names]] or null}}
+#
+# This deliberately sticks to the standard library (no qt, no kde) so it can run outside of kate, which also
+# lets the plugin import the bits both sides need (socketPath(), toStr(), Sweeper) instead of copying them.
+
+import os
+import sys
+import errno
+import fcntl
+import socket
+import select
+import json
+import stat
+import struct
+import hashlib
+import ctypes
+import ctypes.util
+from time import time
+
+TICK = 1.0             # seconds between housekeeping passes (polling slices, unloading, idle check)
+POLL_MIN = 2.0         # seconds between mtime sweeps of unwatched dirs while things are changing
+POLL_MAX = 60.0        # seconds between them once they've been quiet for a while
+SWEEP_SLICE = 0.2      # seconds of stat()ing unwatched dirs per tick, per project
+SETTLE_TIME = 1.0      # mtimes are only good to the second on some filesystems (NFSv3, ext3)
+WATCH_BUDGET = 256     # inotify watches across all projects, the plugin passes its watch_budget setting
+IDLE_TIMEOUT = 300.0   # seconds with no clients before we exit
+UNLOAD_TIMEOUT = 60.0  # seconds a project stays loaded with no subscribers
+
+
+# the socket and lock file live in a 0700 dir under the (per-user) cache dir, never somewhere shared like /tmp
+def runtimeDir(cache_dir):
+  return os.path.join(cache_dir, 'run')
+
+
+def socketPath(cache_dir):
+  return os.path.join(runtimeDir(cache_dir), 'daemon.sock')
+
+
+# creates path as a private dir if need be, and makes sure it's still ours and nobody else's
+def privateDir(path):
+  if not os.path.isdir(path):
+    os.makedirs(path, 0o700)
+  st = os.lstat(path)
+  if stat.S_ISDIR(st.st_mode) and st.st_uid == os.getuid() and st.st_mode & 0o77:
+    os.chmod(path, 0o700)
+    st = os.lstat(path)
+  if not stat.S_ISDIR(st.st_mode) or st.st_uid != os.getuid() or st.st_mode & 0o77:
+    raise OSError(errno.EPERM, "not a private directory", path)
+
+
+def log(s):
+  sys.stderr.write("directory_project_daemon: %s\n" % s)
+
+
+# json hands back unicode, but every path on both sides is a (utf-8) str
+def toStr(obj):
+  if isinstance(obj, unicode):
+    return obj.encode('utf-8')
+  if isinstance(obj, list):
+    return [toStr(x) for x in obj]
+  if isinstance(obj, dict):
+    return dict([(toStr(k), toStr(v)) for k, v in obj.items()])
+  return obj
+
+
+# mirrors what the plugin gets out of QDir: no hidden files, no . and ..
+def listDir(path):
+  dirs, files = [], []
+  for name in sorted(os.listdir(path)):
+    if name.startswith('.'): continue
+    if os.path.isdir(os.path.join(path, name)):
+      dirs.append(name)
+    else:
+      files.append(name)
+  return dirs, files
+
+
+# whether a dir that had the given mtime when it was scanned (at time scanned) needs scanning again.  a
+# change in the same second as the scan can leave a coarse mtime where it was, so a dir modified that close
+# to its scan hasn't settled yet and counts as stale until a later scan.
+def isStale(path, mtime, scanned):
+  try:
+    current = os.stat(path).st_mtime
+  except OSError:
+    current = None
+  return current != mtime or (mtime is not None and scanned - mtime < SETTLE_TIME)
+
+
+# Round robin mtime sweeps over whatever isn't being watched, a time boxed slice per step() so huge trees
+# (or slow mounts) don't stall everything else.  A whole sweep that finds nothing doubles the wait before
+# the next one (up to max_interval), finding anything drops it right back to min_interval.  Intervals are
+# in whatever unit the caller likes, slice_time is in seconds.
+class Sweeper:
+
+  def __init__(self, min_interval, max_interval, slice_time):
+    self.min_interval = min_interval
+    self.max_interval = max_interval
+    self.slice_time = slice_time
+    self.reset()
+
+  def reset(self):
+    self.queue = []
+    self.changed = False
+    self.interval = self.min_interval
+
+  # paths() gives what to check when a new sweep starts and check(path) says whether path changed.  returns
+  # None while the sweep is still going (step again soon), otherwise how long to wait before the next one.
+  def step(self, paths, check):
+    if not self.queue:
+      self.queue = list(paths())
+      self.changed = False
+
+    # always at least one, so a slow check can't stop the sweep from getting anywhere
+    deadline = time() + self.slice_time
+    while self.queue:
+      if check(self.queue.pop()): self.changed = True
+      if time() >= deadline: break
+    if self.queue: return None
+
+    if self.changed:
+      self.interval = self.min_interval
+    else:
+      self.interval = min(self.interval * 2, self.max_interval)
+    return self.interval
+
+
+# Just enough of inotify(7) through ctypes.  Watches are per path and reference counted, since projects with
+# different ignore lists can share dirs and the kernel hands back the same watch for the same path.
+class Inotify:
+
+  IN_MOVED_FROM = 0x40
+  IN_MOVED_TO = 0x80
+  IN_CREATE = 0x100
+  IN_DELETE = 0x200
+  IN_DELETE_SELF = 0x400
+  IN_MOVE_SELF = 0x800
+  IN_Q_OVERFLOW = 0x4000
+  IN_IGNORED = 0x8000
+  IN_ONLYDIR = 0x01000000
+  IN_NONBLOCK = 0o4000
+  IN_CLOEXEC = 0o2000000
+
+  # only changes to a dir's listing matter, not changes to the files in it
+  MASK = IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR
+
+  def __init__(self, limit):
+    self.limit = limit # most watches we'll hold at once
+    self.libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno = True)
+    self.fd = self.libc.inotify_init1(Inotify.IN_NONBLOCK | Inotify.IN_CLOEXEC)
+    if self.fd < 0:
+      raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+    self.wds = {} # watch descriptor => path
+    self.paths = {} # path => [watch descriptor, reference count]
+
+  def fileno(self):
+    return self.fd
+
+  # returns False when there's no watch to be had (over the limit, out of watches, no permission, dir gone)
+  def add(self, path):
+    entry = self.paths.get(path)
+    if entry:
+      entry[1] += 1
+      return True
+    if len(self.paths) >= self.limit:
+      return False
+    wd = self.libc.inotify_add_watch(self.fd, path, Inotify.MASK)
+    if wd < 0:
+      return False
+    self.wds[wd] = path
+    self.paths[path] = [wd, 1]
+    return True
+
+  def remove(self, path):
+    entry = self.paths.get(path)
+    if not entry: return
+    entry[1] -= 1
+    if entry[1] > 0: return
+    del self.paths[path]
+    self.wds.pop(entry[0], None)
+    self.libc.inotify_rm_watch(self.fd, entry[0])
+
+  # returns (dirs whose listing changed, dirs the kernel stopped watching, whether it overflowed and dropped
+  # events).  a dropped dir that turns up again needs a fresh watch, see Project.forget().
+  def read(self):
+    dirty, dropped, overflow = set(), set(), False
+    while True:
+      try:
+        data = os.read(self.fd, 65536)
+      except OSError as e:
+        if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK): break
+        raise
+      offset = 0
+      while offset < len(data):
+        wd, mask, cookie, length = struct.unpack_from('iIII', data, offset)
+        offset += 16 + length
+        if mask & Inotify.IN_Q_OVERFLOW:
+          overflow = True
+          continue
+        path = self.wds.get(wd)
+        if path is None: continue
+        if mask & Inotify.IN_IGNORED:
+          # the kernel dropped the watch itself (the dir is gone)
+          del self.wds[wd]
+          self.paths.pop(path, None)
+          dropped.add(path)
+        dirty.add(path)
+    return dirty, dropped, overflow
+
+
+class Project:
+
+  def __init__(self, root, ignore, cache_dir, watcher, watch_budget):
+    self.root = root
+    self.ignore = ignore
+    self.cache_path = os.path.join(cache_dir, 'index-%s.json' % hashlib.md5(repr((root, ignore))).hexdigest())
+    self.index = {} # dir path => (mtime, time scanned, [dir names], [file names])
+    self.subscribers = set()
+    self.idle_since = None
+    self.watcher = watcher # an Inotify, or None to poll everything
+    self.watch_budget = max(1, watch_budget) # the root always gets one
+    self.watched = set() # dirs we hold an inotify watch for, everything else gets polled
+    self.recent = [] # recently changed dirs, most recent last
+    self.sweeper = Sweeper(POLL_MIN, POLL_MAX, SWEEP_SLICE)
+    self.next_poll = time() + POLL_MIN
+
+  # loads the saved index if there is one and brings it up to date, otherwise scans from scratch
+  def load(self):
+    t1 = time()
+    try:
+      f = open(self.cache_path)
+      try:
+        for path, (mtime, scanned, dirs, files) in json.load(f).items():
+          self.index[toStr(path)] = (mtime, scanned, toStr(dirs), toStr(files))
+      finally:
+        f.close()
+    except (IOError, OSError, ValueError, TypeError):
+      self.index = {}
+
+    if self.root in self.index:
+      changed = self.sweep(self.index.keys())
+    else:
+      self.index = {}
+      changed = self.scanDir(self.root)
+    # a first scan isn't a change, so only the root gets watched to start with
+    self.rebalance(changed)
+    log("loaded %s in %f seconds (%d dirs, %d changed)" % (self.root, time()-t1, len(self.index), len(changed)))
+
+  def save(self):
+    try:
+      f = open(self.cache_path, 'w')
+      try:
+        json.dump(self.index, f)
+      finally:
+        f.close()
+    except (IOError, OSError, ValueError) as e:
+      log("could not save index for %s: %s" % (self.root, e))
+
+  # same rules as the plugin's DirectoryProject.scanDir(): known subdirs are left alone, new ones are
+  # scanned recursively (unless ignored), and vanished ones are dropped.  returns {dir: entry or None} for
+  # the dirs whose listing actually changed.
+  def scanDir(self, path, changed = None):
+    if changed is None: changed = {}
+    scanned = time()
+    try:
+      mtime = os.stat(path).st_mtime
+      dirs, files = listDir(path)
+    except OSError:
+      self.dropDir(path, changed)
+      return changed
+
+    old = self.index.get(path)
+    self.index[path] = (mtime, scanned, dirs, files)
+    if not old or old[2:] != (dirs, files):
+      changed[path] = self.index[path]
+
+    if old:
+      for name in set(old[2]).difference(dirs):
+        self.dropDir(os.path.join(path, name), changed)
+    for name in dirs:
+      sub_path = os.path.join(path, name)
+      if name not in self.ignore and sub_path not in self.index:
+        self.scanDir(sub_path, changed)
+    return changed
+
+  def dropDir(self, path, changed):
+    self.unwatch(path)
+    entry = self.index.pop(path, None)
+    if entry:
+      changed[path] = None
+      for name in entry[2]:
+        self.dropDir(os.path.join(path, name), changed)
+
+  # stat()s paths and rescans the stale ones
+  def sweep(self, paths):
+    changed = {}
+    for path in paths:
+      self.checkDir(path, changed)
+    return changed
+
+  # returns whether rescanning path turned up anything
+  def checkDir(self, path, changed):
+    entry = self.index.get(path)
+    if not entry or not isStale(path, entry[0], entry[1]): return False
+    count = len(changed)
+    self.scanDir(path, changed)
+    return len(changed) > count
+
+  def unwatchedDirs(self):
+    return [path for path in self.index if path not in self.watched]
+
+  def watch(self, path):
+    if path not in self.watched and self.watcher.add(path):
+      self.watched.add(path)
+
+  def unwatch(self, path):
+    if path in self.watched:
+      self.watched.discard(path)
+      self.watcher.remove(path)
+
+  # things that just changed are likely to change again, so they get the watches.  call this with
+  # whatever scanDir() or sweep() found, even if that's nothing, so dropped watches get put back.
+  def touch(self, changed):
+    for path, entry in changed.items():
+      if not entry: continue
+      if path in self.recent: self.recent.remove(path)
+      self.recent.append(path)
+    del self.recent[:-self.watch_budget]
+    self.rebalance(changed)
+
+  # watches the root first, then the most recently changed dirs, up to the budget.  a dir that just got
+  # its watch is checked once more, in case it changed since it was last scanned; anything that turns up
+  # goes in changed.
+  def rebalance(self, changed):
+    if not self.watcher: return
+    wanted = set()
+    for path in [self.root] + self.recent[::-1]:
+      if len(wanted) >= self.watch_budget: break
+      if path in self.index: wanted.add(path)
+
+    for path in self.watched.difference(wanted):
+      self.unwatch(path)
+    for path in wanted.difference(self.watched):
+      self.watch(path)
+      if path in self.watched:
+        self.checkDir(path, changed)
+
+  # the kernel already dropped these watches, so there's nothing to remove; rebalance() puts them back
+  def forget(self, paths):
+    self.watched.difference_update(paths)
+
+  def close(self):
+    for path in list(self.watched):
+      self.unwatch(path)
+
+  # checks the next slice of unwatched dirs, see Sweeper
+  def poll(self, now):
+    if now < self.next_poll: return {}
+    changed = {}
+    interval = self.sweeper.step(self.unwatchedDirs, lambda path: self.checkDir(path, changed))
+    self.next_poll = now + (interval or 0)
+    self.touch(changed)
+    return changed
+
+  def message(self, event, **kwargs):
+    kwargs['event'] = event
+    kwargs['root'] = self.root
+    return kwargs
+
+  def indexMessage(self):
+    return self.message('index', index = dict([(path, entry[2:]) for path, entry in self.index.items()]))
+
+  def changedMessage(self, changed):
+    dirs = {}
+    for path, entry in changed.items():
+      dirs[path] = entry and entry[2:]
+    return self.message('changed', dirs = dirs)
+
+
+class Client:
+
+  def __init__(self, sock):
+    self.sock = sock
+    self.sock.setblocking(0)
+    self.in_buffer = ''
+    self.out_buffer = ''
+
+  def send(self, message):
+    self.out_buffer += json.dumps(message) + '\n'
+
+  # returns False when the other end has gone away
+  def flush(self):
+    try:
+      sent = self.sock.send(self.out_buffer)
+      self.out_buffer = self.out_buffer[sent:]
+    except socket.error as e:
+      return e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK)
+    return True
+
+  # returns the complete lines received so far, or None when the other end hung up
+  def receive(self):
+    data = self.sock.recv(65536)
+    if not data: return None
+    self.in_buffer += data
+    lines = self.in_buffer.split('\n')
+    self.in_buffer = lines.pop()
+    return lines
+
+
+class Daemon:
+
+  def __init__(self, cache_dir, watch_budget):
+    self.cache_dir = cache_dir
+    self.watch_budget = watch_budget
+    self.projects = {} # (root, ignore) => Project
+    self.clients = {} # socket => Client
+    self.idle_since = time()
+    self.server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    self.server.bind(socketPath(cache_dir))
+    self.server.listen(5)
+
+    try:
+      self.watcher = Inotify(watch_budget)
+    except (OSError, AttributeError) as e:
+      log("no inotify, polling everything instead: %s" % e)
+      self.watcher = None
+
+  def run(self):
+    next_poll = time() + TICK
+    while True:
+      readers = [self.server] + self.clients.keys()
+      if self.watcher: readers.append(self.watcher)
+      writers = [sock for sock, client in self.clients.items() if client.out_buffer]
+      readable, writable, _ = select.select(readers, writers, [], max(0, next_poll - time()))
+
+      for sock in readable:
+        if sock is self.server:
+          sock, _ = self.server.accept()
+          self.clients[sock] = Client(sock)
+        elif sock is self.watcher:
+          self.watchedChanges()
+        else:
+          self.read(sock)
+      for sock in writable:
+        if sock in self.clients and not self.clients[sock].flush():
+          self.disconnect(self.clients[sock])
+
+      if time() >= next_poll:
+        self.poll()
+        next_poll = time() + TICK
+        if not self.clients and time() - self.idle_since > IDLE_TIMEOUT:
+          break
+
+    for project in self.projects.values():
+      project.save()
+      project.close()
+    log("idle, exiting")
+
+  def read(self, sock):
+    client = self.clients[sock]
+    try:
+      lines = client.receive()
+    except socket.error:
+      lines = None
+    if lines is None:
+      self.disconnect(client)
+      return
+
+    for line in lines:
+      try:
+        request = json.loads(line)
+        root = toStr(request['root'])
+        key = (root, tuple(sorted(toStr(request.get('ignore', [])))))
+      except (ValueError, KeyError, TypeError, AttributeError):
+        log("bad request: %r" % line)
+        continue
+      if request.get('cmd') == 'subscribe':
+        self.subscribe(client, key)
+      elif request.get('cmd') == 'unsubscribe':
+        self.unsubscribe(client, key)
+
+  def subscribe(self, client, key):
+    project = self.projects.get(key)
+    if not project:
+      project = Project(key[0], key[1], self.cache_dir, self.watcher, self.watch_budget)
+      project.load()
+      self.projects[key] = project
+    else:
+      # watched dirs are already up to date, only the polled ones could be behind
+      changed = project.sweep(project.unwatchedDirs())
+      project.touch(changed)
+      self.broadcast(project, changed)
+    project.subscribers.add(client)
+    project.idle_since = None
+    client.send(project.indexMessage())
+
+  def unsubscribe(self, client, key):
+    project = self.projects.get(key)
+    if project and client in project.subscribers:
+      project.subscribers.discard(client)
+      if not project.subscribers: project.idle_since = time()
+
+  def disconnect(self, client):
+    for key, project in self.projects.items():
+      self.unsubscribe(client, key)
+    del self.clients[client.sock]
+    client.sock.close()
+    if not self.clients: self.idle_since = time()
+
+  def broadcast(self, project, changed):
+    if not changed: return
+    message = project.changedMessage(changed)
+    for client in project.subscribers:
+      client.send(message)
+
+  def watchedChanges(self):
+    dirty, dropped, overflow = self.watcher.read()
+    for project in self.projects.values():
+      project.forget(dropped)
+      # the kernel dropped events, so nothing short of checking everything will do
+      if overflow:
+        changed = project.sweep(project.index.keys())
+      else:
+        changed = {}
+        for path in dirty:
+          if path in project.index:
+            project.scanDir(path, changed)
+      project.touch(changed)
+      self.broadcast(project, changed)
+
+  def poll(self):
+    now = time()
+    for key, project in self.projects.items():
+      if project.idle_since and now - project.idle_since > UNLOAD_TIMEOUT:
+        project.save()
+        project.close()
+        del self.projects[key]
+      elif project.subscribers:
+        self.broadcast(project, project.poll(now))
+
+
+def main():
+  cache_dir = len(sys.argv) > 1 and sys.argv[1] or os.path.expanduser('~/.directory_project')
+  try:
+    watch_budget = int(sys.argv[2])
+  except (IndexError, ValueError):
+    watch_budget = WATCH_BUDGET
+  try:
+    if not os.path.isdir(cache_dir): os.makedirs(cache_dir, 0o700)
+    privateDir(runtimeDir(cache_dir))
+  except OSError as e:
+    log("refusing to start: %s" % e)
+    return
+
+  # only one daemon per user.  whoever holds the lock owns the socket, anybody else just leaves.
+  try:
+    lock_fd = os.open(os.path.join(runtimeDir(cache_dir), 'daemon.lock'), os.O_WRONLY | os.O_CREAT | os.O_NOFOLLOW, 0o600)
+    fcntl.flock(lock_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+  except (IOError, OSError):
+    return
+  if os.path.lexists(socketPath(cache_dir)): os.unlink(socketPath(cache_dir))
+
+  try:
+    Daemon(cache_dir, watch_budget).run()
+  finally:
+    os.unlink(socketPath(cache_dir))
+
+
+if __name__ == '__main__':
+  main()